@@ -5,14 +5,26 @@ import hashlib
 import logging
 import time
 import asyncio
-import sqlite3
 from dataclasses import dataclass
-from typing import Optional, Dict
+from functools import lru_cache
+from typing import Any, Optional, Dict, List, Tuple
+from .db import connect
 # pylint: disable=broad-except
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 FFPROBE = os.path.join(BASE_DIR, "ffprobe")
 FFMPEG = os.path.join(BASE_DIR, "ffmpeg")
+FLUSH_DELAY = 0.2    # seconds to collect DB writes before committing them
+FLUSH_COUNT = 64     # commit immediately once this many writes are pending
+SELECT_ITEM = "SELECT mediatype, stream, cache, mtime, size FROM media WHERE path = ?"
+SAVE_PROBE = "INSERT OR REPLACE INTO media (mediatype, stream, mtime, size, path) VALUES (?, ?, ?, ?, ?)"
+SAVE_CACHE = "UPDATE media SET cache = ? WHERE path = ?"
+TOUCH_CACHE = ("INSERT INTO cache_lru (path, size, atime) VALUES (?, ?, ?) "
+               "ON CONFLICT(path) DO UPDATE SET size = excluded.size, atime = excluded.atime")
+AUDIO_STREAM_RE = re.compile(r'Stream #(\d+:\d+)([^:]*): Audio: (\S+)', re.MULTILINE)
+CLEANUP_MIN_AGE = 600  # never evict cache files accessed within this many seconds
+TOUCH_INTERVAL = 30    # minimum seconds between LRU updates for the same cache file
+PROBE_CONCURRENCY = os.cpu_count() or 4  # ffprobe processes allowed to run at once
 
 @dataclass(frozen=True)
 class Item:
@@ -20,46 +32,82 @@ class Item:
     mediatype: str
     stream: str
     cache: Optional[str]
+    mtime: Optional[float]
+    size: Optional[int]
 
-class AudioExtractor:
+class AudioExtractor:  # pylint: disable=too-many-instance-attributes
     """Transcoder"""
 
     def __init__(self, db_file: str, cache_dir: str, max_size: int) -> None:
-        self._semaphore = asyncio.Semaphore(10)
+        self._semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
         self._cache_dir = cache_dir
         self._max_cache_size = max_size
-        self._db = sqlite3.connect(db_file)
+        self._db = connect(db_file)
         self._cur =self._db.cursor()
-        self._cleanup: Optional[asyncio.Task] = asyncio.create_task(self.run_cleanup())
-        self._running: Dict[str, asyncio.Event] = {}
+        self._last_touch: Dict[str, float] = {}
+        self._cleanup: Optional[asyncio.Task] = asyncio.create_task(self._index_cache_dir())
+        self._running: Dict[str, asyncio.Task[Optional[str]]] = {}
+        # keyed on (sql, path) so a newer write to the same row replaces the queued one
+        self._pending_writes: Dict[Tuple[str, str], Tuple[Any, ...]] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
         os.makedirs(cache_dir, exist_ok=True)
         self._cur.execute("CREATE TABLE IF NOT EXISTS media ("
             "path TEXT PRIMARY KEY,"
             "mediatype TEXT NOT NULL,"
             "stream TEXT NOT NULL,"
-            "cache TEXT"
+            "cache TEXT,"
+            "mtime REAL,"
+            "size INTEGER"
             ")")
+        columns = {row[1] for row in self._cur.execute("PRAGMA table_info(media)")}
+        for column, coltype in (("mtime", "REAL"), ("size", "INTEGER")):
+            if column not in columns:
+                self._cur.execute(f"ALTER TABLE media ADD COLUMN {column} {coltype}")
+        # LRU index of the cache dir, with the running total maintained by triggers
+        self._cur.execute("CREATE TABLE IF NOT EXISTS cache_lru ("
+            "path TEXT PRIMARY KEY,"
+            "size INTEGER NOT NULL,"
+            "atime REAL NOT NULL"
+            ")")
+        self._cur.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._cur.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('total_size', 0)")
+        self._cur.execute("CREATE TRIGGER IF NOT EXISTS cache_lru_insert AFTER INSERT ON cache_lru BEGIN "
+            "UPDATE meta SET value = value + NEW.size WHERE key = 'total_size'; END")
+        self._cur.execute("CREATE TRIGGER IF NOT EXISTS cache_lru_delete AFTER DELETE ON cache_lru BEGIN "
+            "UPDATE meta SET value = value - OLD.size WHERE key = 'total_size'; END")
+        self._cur.execute("CREATE TRIGGER IF NOT EXISTS cache_lru_update AFTER UPDATE OF size ON cache_lru BEGIN "
+            "UPDATE meta SET value = value - OLD.size + NEW.size WHERE key = 'total_size'; END")
+
     def get_item(self, path: str) -> Optional[Item]:
         """Get mediatype and path for extracted audio"""
-        for row in self._cur.execute("SELECT mediatype, stream, cache FROM media WHERE path = ?", (path,)):
+        # Only a queued write to this row has to be committed first, other reads leave the batch to fill up
+        if (SAVE_PROBE, path) in self._pending_writes or (SAVE_CACHE, path) in self._pending_writes:
+            self.flush_writes()
+        for row in self._cur.execute(SELECT_ITEM, (path,)):
             return Item(*row)
         return None
 
     async def get_path(self, path: str) -> str:
         """Get path to audio file.  Create if needed"""
+        if path in self._running:
+            # Another request is already extracting this file, share its result
+            running_path = await asyncio.shield(self._running[path])
+            assert running_path
+            return running_path
         item = self.get_item(path)
         assert item
-        if path in self._running:
+        cache_path = item.cache
+        size = None
+        if cache_path:
             try:
-                await self._running[path].wait()
-                del self._running[path]
-            except Exception:
+                size = os.stat(cache_path).st_size
+            except FileNotFoundError:
                 pass
-        cache_path = item.cache
-        if not cache_path or not os.path.exists(cache_path):
+        if cache_path and size is not None:
+            self._touch(cache_path, size)  # keep on top of the LRU list
+        else:
             cache_path = await self.extract_audio(path, item)
         assert cache_path
-        os.utime(cache_path)  # keep on top of the LRU list
         return cache_path
 
     async def extract_audio(self, path: str, item: Item) -> Optional[str]:
@@ -71,8 +119,14 @@ class AudioExtractor:
         if not self._cleanup:
             self._cleanup = asyncio.create_task(self.run_cleanup())
 
+        if path not in self._running:
+            self._running[path] = asyncio.create_task(self._extract(path, item))
+        # Shared by every request for path, so a client disconnecting mustn't cancel it for the others
+        return await asyncio.shield(self._running[path])
+
+    async def _extract(self, path: str, item: Item) -> Optional[str]:
+        """Run ffmpeg to extract the audio of path into the cache dir"""
         cache_file = self._get_cache_file(path, item.mediatype)
-        self._running[path] = asyncio.Event()
         try:
             tmpname = os.path.join(self._cache_dir, "tmp." + os.path.basename(cache_file))
             if os.path.exists(tmpname):
@@ -81,27 +135,87 @@ class AudioExtractor:
             await proc.wait()
             if os.path.exists(tmpname):
                 os.rename(tmpname, cache_file)
-                self._cur.execute("UPDATE media SET cache = ? WHERE path = ?", (cache_file, path))
-                self._db.commit()
-                self._running[path].set()
+                self._touch(cache_file, os.stat(cache_file).st_size)
+                self._queue_write(SAVE_CACHE, path, (cache_file, path))
                 return cache_file
         except Exception as _e:
             logging.error("Failed to extract audio for %s: %s", path, _e)
+        finally:
+            del self._running[path]
         return None
 
     async def run_cleanup(self) -> None:
         """Cleanup LRU files in cache dir"""
-        paths = sorted(os.scandir(self._cache_dir), key=lambda x: x.stat().st_mtime)
-        while sum(_.stat().st_size for _ in paths) > self._max_cache_size:
-            item = paths.pop()
-            if item.stat().st_mtime > time.time() - 600:
-                break
-            os.unlink(item.path)
-
-    async def probe(self, path: str) -> Optional[str]:
-        """Probe Video file to get audio format"""
+        self.flush_writes()
+        total_size, = self._cur.execute("SELECT value FROM meta WHERE key = 'total_size'").fetchone()
+        if total_size <= self._max_cache_size:
+            return
+        # Everything past the most-recently-used max_cache_size bytes is evicted
+        rows = self._cur.execute(
+            "SELECT path FROM ("
+            "SELECT path, atime, SUM(size) OVER (ORDER BY atime DESC) AS kept FROM cache_lru"
+            ") WHERE kept > ? AND atime < ? ORDER BY atime ASC",
+            (self._max_cache_size, time.time() - CLEANUP_MIN_AGE)).fetchall()
+        # unlinking can be slow on network filesystems, so keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self._unlink_files, [path for path, in rows])
+        self._cur.executemany("DELETE FROM cache_lru WHERE path = ?", rows)
+        for path, in rows:
+            self._last_touch.pop(path, None)
+
+    async def _index_cache_dir(self) -> None:
+        """Add files already in the cache dir to the LRU index, then clean up"""
+        # Files left by an earlier version or a crash would otherwise never be counted or evicted
+        files = await asyncio.get_running_loop().run_in_executor(None, self._scan_cache_dir, time.time())
+        self.flush_writes()
+        try:
+            self._cur.execute("BEGIN IMMEDIATE")
+            self._cur.executemany("INSERT OR IGNORE INTO cache_lru (path, size, atime) VALUES (?, ?, ?)", files)
+            self._cur.execute("COMMIT")
+        except Exception as _e:
+            logging.error("Failed to index cache dir %s: %s", self._cache_dir, _e)
+            if self._db.in_transaction:
+                self._cur.execute("ROLLBACK")
+        await self.run_cleanup()
+
+    def _scan_cache_dir(self, started: float) -> List[Tuple[str, int, float]]:
+        """Get (path, size, mtime) of the cache files, removing partial extractions from before started"""
+        files = []
+        with os.scandir(self._cache_dir) as dir_it:
+            for entry in dir_it:
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    if not entry.name.startswith("tmp."):
+                        files.append((entry.path, stat.st_size, stat.st_mtime))
+                    elif stat.st_mtime < started:
+                        os.unlink(entry.path)
+                except OSError as _e:
+                    logging.error("Failed to index cache file %s: %s", entry.path, _e)
+        return files
+
+    @staticmethod
+    def _unlink_files(paths: List[str]) -> None:
+        """Remove evicted cache files"""
+        for path in paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    async def probe(self, path: str, stat: Optional[Tuple[float, int]] = None) -> Optional[str]:
+        """Probe Video file to get audio format.  stat is the (mtime, size) of path if it is already known"""
+        if stat is None:
+            try:
+                # stat can block for a long time on network shares, so keep it off the event loop
+                stat_result = await asyncio.get_running_loop().run_in_executor(None, os.stat, path)
+            except OSError as _e:
+                logging.error("Failed to probe %s: %s", path, _e)
+                return None
+            stat = (stat_result.st_mtime, stat_result.st_size)
+        mtime, size = stat
         item = self.get_item(path)
-        if item:
+        if item and item.mtime == mtime and item.size == size:
             return item.mediatype
         async with self._semaphore:
             try:
@@ -113,20 +227,70 @@ class AudioExtractor:
         if proc.returncode != 0:
             logging.error("Failed to run ffprobe %s: %s", path, stderr_data)
             return None
-        matches = re.findall(r'Stream #(\d+:\d+)([^:]*): Audio: (\S+)', stderr_data.decode(), re.MULTILINE)
+        # Only the stream table is of interest, so skip decoding the banner/metadata before it
+        stream_table = stderr_data[max(stderr_data.find(b'Stream #'), 0):]
+        matches = AUDIO_STREAM_RE.findall(stream_table.decode('utf-8', errors='replace'))
         if matches and (_match :=
                next((_m for _m in matches if 'eng' in _m[1]), None) or
                next((_m for _m in matches if not _m[1]), None) or
                matches[0]):
             audio_type = _match[2].replace(',', '')
             stream = _match[0]
-            self._cur.execute("INSERT OR REPLACE INTO media (mediatype, stream, path) VALUES (?, ?, ?)", (audio_type, stream, path))
-            self._db.commit()
+            self._queue_write(SAVE_PROBE, path, (audio_type, stream, mtime, size, path))
             logging.debug("Found %s audio in %s", audio_type, path)
         else:
             logging.error("Failed to locate any audio in %s", path)
         return audio_type
 
+    def _touch(self, cache_path: str, size: int) -> None:
+        """Mark cache file as most recently used"""
+        # players re-request the same file repeatedly while playing, one LRU update per interval is plenty
+        now = time.time()
+        if now - self._last_touch.get(cache_path, 0) < TOUCH_INTERVAL:
+            return
+        self._last_touch[cache_path] = now
+        self._queue_write(TOUCH_CACHE, cache_path, (cache_path, size, now))
+
+    def _queue_write(self, sql: str, path: str, params: Tuple[Any, ...]) -> None:
+        """Queue a DB write to be committed with the next batch"""
+        # re-insert so the dict order reflects the latest write for this row
+        self._pending_writes.pop((sql, path), None)
+        self._pending_writes[(sql, path)] = params
+        if len(self._pending_writes) >= FLUSH_COUNT:
+            self.flush_writes()
+        elif not self._flush_handle:
+            self._flush_handle = asyncio.get_running_loop().call_later(FLUSH_DELAY, self.flush_writes)
+
+    def flush_writes(self) -> None:
+        """Commit all queued DB writes in a single transaction"""
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending_writes:
+            return
+        # Group consecutive writes sharing a statement so ordering between statements is kept
+        batches: List[Tuple[str, List[Tuple[Any, ...]]]] = []
+        for (sql, _path), params in self._pending_writes.items():
+            if batches and batches[-1][0] == sql:
+                batches[-1][1].append(params)
+            else:
+                batches.append((sql, [params]))
+        self._pending_writes.clear()
+        try:
+            self._cur.execute("BEGIN IMMEDIATE")
+            for sql, params_list in batches:
+                self._cur.executemany(sql, params_list)
+            self._cur.execute("COMMIT")
+        except Exception as _e:
+            logging.error("Failed to write to media DB: %s", _e)
+            if self._db.in_transaction:
+                self._cur.execute("ROLLBACK")
+
     def _get_cache_file(self, path: str, audio_type: str) -> str:
         return os.path.join(self._cache_dir,
-            os.path.basename(path) + "." + hashlib.sha256(os.path.dirname(path).encode()).hexdigest()[:8] + "." + audio_type)
+            os.path.basename(path) + "." + _dirhash(os.path.dirname(path)) + "." + audio_type)
+
+@lru_cache(maxsize=4096)
+def _dirhash(dirname: str) -> str:
+    """Short hash to disambiguate identically named files from different directories"""
+    return hashlib.blake2b(dirname.encode(), digest_size=4).hexdigest()
@@ -11,6 +11,9 @@ from async_upnp_client.server import create_template_var, create_event_var
 # pylint: disable=invalid-name
 # pylint: disable=unused-argument)
 
+SOURCE_PROTOCOL_INFO = ("http-get:*:audio/mpeg:*,http-get:*:audio/ac3:*,http-get:*:audio/aac:*,"
+                        "http-get:*:audio/ogg:*,http-get:*:audio/eac3:*")
+
 class ConnectionManagerService(UpnpServerService):
     """DLNA Connection Manager."""
     SERVICE_DEFINITION = ServiceInfo(
@@ -22,8 +25,7 @@ class ConnectionManagerService(UpnpServerService):
         xml=ET.Element("server_service"),
     )
     STATE_VARIABLE_DEFINITIONS = {
-        "SourceProtocolInfo": create_event_var("string",
-            default=','.join([f'http-get:*:audio/{_}:*' for _ in ('mpeg', 'ac3', 'aac', 'ogg', 'eac3')])),
+        "SourceProtocolInfo": create_event_var("string", default=SOURCE_PROTOCOL_INFO),
         "SinkProtocolInfo": create_event_var("string"),
         "CurrentConnectionIDs": create_event_var("string"),
         "A_ARG_TYPE_ConnectionStatus": create_template_var("string"),
@@ -1,9 +1,9 @@
 """Content Directory"""
 import asyncio
 import logging
+import time
 
-from typing import Dict, Optional, Callable, Any, AsyncIterable, cast
-from collections import defaultdict
+from typing import Dict, List, Optional, Callable, Any, AsyncIterable, Tuple, cast
 import xml.etree.ElementTree as ET
 
 from async_upnp_client.client import UpnpStateVariable, UpnpDevice, UpnpEventableStateVariable
@@ -13,9 +13,10 @@ from async_upnp_client.server import UpnpServerService, callable_action
 from async_upnp_client.server import create_template_var, create_state_var, create_event_var
 from async_upnp_client.exceptions import UpnpActionError, UpnpActionErrorCode
 from .items import BaseItem, DirectoryItem
-from .namespace import get_ns
+from .namespace import DIDL_NS
 
 # pylint: disable=too-many-arguments
+# pylint: disable=too-many-locals
 # pylint: disable=invalid-name
 # pylint: disable=unused-argument)
 FEATURE_STR = """<?xml version="1.0" encoding="UTF-8"?>
@@ -26,10 +27,14 @@ FEATURE_STR = """<?xml version="1.0" encoding="UTF-8"?>
  urn:schemas-upnp-org:av:avs
  http://www.upnp.org/schemas/av/avs-v1-20060531.xsd">
 </Features>"""
+SCAN_FLUSH_COUNT = 100      # publish scan progress after this many new items
+SCAN_FLUSH_INTERVAL = 0.25  # or once this many seconds have passed
+DIDL_START = '<DIDL-Lite ' + ' '.join(f'{_k}="{_v}"' for _k, _v in DIDL_NS.items()) + '>'
+DIDL_END = '</DIDL-Lite>'
 
 class ContentDirectoryService(UpnpServerService):
     """DLNA Content Directory."""
-    SCANNER: Optional[Callable[[BaseItem, UpnpDevice], AsyncIterable[BaseItem]]] = None
+    SCANNER: Optional[Callable[[BaseItem, UpnpDevice], AsyncIterable[List[BaseItem]]]] = None
     SERVICE_DEFINITION = ServiceInfo(
         service_id="urn:upnp-org:serviceId:ContentDirectory",
         service_type="urn:schemas-upnp-org:service:ContentDirectory:2",
@@ -79,16 +84,23 @@ class ContentDirectoryService(UpnpServerService):
         await self._scan_task
         try:
             objectid = int(ObjectID)
-            parent = self._item_map[objectid]
+            parent = self.get_item(objectid)
             assert isinstance(parent, DirectoryItem)
-            root =  ET.Element("DIDL-Lite", get_ns('dc', 'upnp', 'DIDL-Lite'))
-            for child in sorted(parent.children, key=lambda x: x.name):
-                root.append(await child.xml())
-            xml = ET.tostring(root).decode()
+            # Resolving renames transcoded items and bumps the container's update_id, so it has to happen
+            # before the children are sorted and the update_id is read
+            await self.resolve_children(parent)
             if isinstance(parent, DirectoryItem):
                 update_id = parent.update_id
             else:
                 update_id = self.state_variable('SystemUpdateID').value
+            children = parent.sorted_children()
+            page = children[StartingIndex:StartingIndex + RequestedCount] if RequestedCount else children[StartingIndex:]
+            cached = self._browse_cache.get(objectid)
+            if cached and cached[:3] == (update_id, StartingIndex, RequestedCount):
+                xml = cached[3]
+            else:
+                xml = self.build_result(page)
+                self._browse_cache[objectid] = (update_id, StartingIndex, RequestedCount, xml)
         except Exception as _e:
             logging.exception("Failed to browse %s", ObjectID)
             raise UpnpActionError(
@@ -96,8 +108,8 @@ class ContentDirectoryService(UpnpServerService):
             ) from _e
         return {
             "Result": self.template_var("A_ARG_TYPE_Result", xml),
-            "NumberReturned": self.template_var("A_ARG_TYPE_Count", len(parent.children)),
-            "TotalMatches": self.template_var("A_ARG_TYPE_Count", len(parent.children)),
+            "NumberReturned": self.template_var("A_ARG_TYPE_Count", len(page)),
+            "TotalMatches": self.template_var("A_ARG_TYPE_Count", len(children)),
             "UpdateID": self.template_var("A_ARG_TYPE_UpdateID", update_id),
         }
 
@@ -155,30 +167,75 @@ class ContentDirectoryService(UpnpServerService):
         """Initialize"""
         super().__init__(*args, **kwargs)
         self._root_item = DirectoryItem(None, None)
-        self._item_map: Dict[int, BaseItem] = {0: self._root_item, self._root_item.object_id: self._root_item}
+        # object_ids are allocated sequentially, so a list indexed by id is a dense lookup table
+        self._items: List[Optional[BaseItem]] = []
+        self._add_item(0, self._root_item)
+        self._add_item(self._root_item.object_id, self._root_item)
+        # Last Browse Result per container with its (update_id, StartingIndex, RequestedCount).  Only one page is
+        # kept per container, so clients paging with arbitrary indexes can't grow it without bound
+        self._browse_cache: Dict[int, Tuple[int, int, int, str]] = {}
         self._scan_task = asyncio.create_task(self._start_scan())
 
     async def _start_scan(self) -> None:
         if not self.SCANNER:
             return
-        updates: Dict[int, int] = defaultdict(int)
+        # Pre-formatted "id,update_id" entries so only the changed container is re-formatted per item
+        updates: Dict[int, str] = {}
+        pending: Dict[int, str] = {}
+        pending_count = 0
+        last_flush = time.monotonic()
         system_update_id = self.state_variable('SystemUpdateID')
         container_update_ids = cast(UpnpEventableStateVariable, self.state_variable('ContainerUpdateIDs'))
-        async for item in self.SCANNER(self._root_item, self.device):  # pylint: disable=not-callable
+
+        def flush() -> None:
+            # Each state-variable change may be evented, so only publish scan progress periodically
+            nonlocal pending_count, last_flush
             if container_update_ids.event_triggered.is_set():
                 updates.clear()
                 container_update_ids.event_triggered.clear()
-            self._item_map[item.object_id] = item
-            updates[item.parent.object_id] = item.parent.update_id
+            updates.update(pending)
+            pending.clear()
             container_update_ids.value = self.build_container_update_ids(updates)
-            system_update_id.value += 1  # type: ignore [operator]
+            system_update_id.value += pending_count  # type: ignore [operator]
+            pending_count = 0
+            last_flush = time.monotonic()
+
+        async for batch in self.SCANNER(self._root_item, self.device):  # pylint: disable=not-callable
+            for item in batch:
+                self._add_item(item.object_id, item)
+                parent = item.parent
+                pending[parent.object_id] = f"{parent.object_id},{parent.update_id}"
+            pending_count += len(batch)
+            if pending_count >= SCAN_FLUSH_COUNT or time.monotonic() - last_flush > SCAN_FLUSH_INTERVAL:
+                flush()
+        if pending_count:
+            flush()
         logging.debug("Done scanning")
 
     def get_item(self, object_id: int) -> Optional[BaseItem]:
         """Get item from object_id."""
-        return self._item_map.get(object_id)
+        if 0 <= object_id < len(self._items):
+            return self._items[object_id]
+        return None
+
+    def _add_item(self, object_id: int, item: BaseItem) -> None:
+        if object_id >= len(self._items):
+            self._items.extend([None] * (object_id - len(self._items) + 1))
+        self._items[object_id] = item
+
+    @staticmethod
+    async def resolve_children(parent: DirectoryItem) -> None:
+        """Wait for the metadata of a container's children to be complete"""
+        # Transcoded items may still be waiting on ffprobe, so let them resolve concurrently
+        if pending := [item.resolve() for item in parent.children if not item.resolved]:
+            await asyncio.gather(*pending)
+
+    @staticmethod
+    def build_result(items: List[BaseItem]) -> str:
+        """Create DIDL-Lite document describing items.  The items must already be resolved"""
+        return DIDL_START + ''.join([item.xml_str() for item in items]) + DIDL_END
 
     @staticmethod
-    def build_container_update_ids(updates: dict[int, int]) -> Any:
-        """Create CSV value for ContainerUpdateIDs"""
-        return ",".join([f"{_id},{_val}" for _id, _val in updates.items()])
+    def build_container_update_ids(updates: dict[int, str]) -> Any:
+        """Create CSV value for ContainerUpdateIDs from pre-formatted 'id,update_id' entries"""
+        return ",".join(updates.values())
@@ -0,0 +1,14 @@
+"""SQLite helpers"""
+import sqlite3
+
+def connect(db_file: str) -> sqlite3.Connection:
+    """Open db_file in autocommit mode, tuned for concurrent reads and writes"""
+    db = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+    if db_file != ":memory:":
+        # WAL lets browse-time reads proceed while probe/extract/scan results are written
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA busy_timeout=30000")
+        db.execute("PRAGMA temp_store=MEMORY")
+        db.execute("PRAGMA cache_size=-20000")
+    return db
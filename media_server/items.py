@@ -1,40 +1,69 @@
 """Item types for ContentDirectory"""
 
-# pylint: disable=too-few-public-methods
+# pylint: disable=too-few-public-methods, too-many-instance-attributes
 import asyncio
 import os
 import mimetypes
-import xml.etree.ElementTree as ET
-from datetime import datetime
-from typing import Optional, List
-from .namespace import get_ns
+import time
+from xml.sax.saxutils import escape
+from functools import lru_cache
+from typing import ClassVar, Optional, List, Sequence, Tuple, cast
 from .audio_extract import AudioExtractor
 
 mimetypes.add_type('audio/ac3', '.eac3')
 mimetypes.add_type('audio/ac3', '.dts')
+# Extension -> mime type for the media served, the strict table taking precedence as in mimetypes.guess_type()
+AUDIO_EXT = {_ext: _mime for _ext, _mime in {**mimetypes.common_types, **mimetypes.types_map}.items()
+             if _mime.startswith('audio/')}
+VIDEO_EXT = {_ext: _mime for _ext, _mime in {**mimetypes.common_types, **mimetypes.types_map}.items()
+             if _mime.startswith('video/')}
+
+_ATTR_ENTITIES = {'"': '&quot;'}
+_BASE_URL: Optional[str] = None
+MEDIA = 'media'  # URL suffixes served by the media handler
+COVER = 'cover'
+KIND_ITEM = 'item'
+KIND_CONTAINER = 'container'
+KIND_AUDIO = 'audio'
+KIND_TRANSCODE = 'transcode'
+MEDIA_KINDS = frozenset((KIND_AUDIO, KIND_TRANSCODE))  # items served by the media handler
 
 class BaseItem:
     """Base item definition"""
-    base_url:Optional[str] = None
-    next_id = 1000
+    # A large library creates an instance per file, so avoid a per-instance __dict__
+    __slots__ = ('_parent', '_path', '_size', '_type', '_cover', '_xml_str',
+                 '_id', '_name', '_id_str', '_parent_id_str', '_date_iso', '_url_prefix')
+    next_id: ClassVar[int] = 1000
+    # Cheap type tag for request handlers, one of the KIND_* constants
+    ITEM_KIND: ClassVar[str] = KIND_ITEM
 
-    def __init__(self, parent: Optional["DirectoryItem"], path: Optional[str], itemtype: str='item') -> None:
+    def __init__(self, parent: Optional["DirectoryItem"], path: Optional[str], itemtype: str='item',
+                 stat: Optional[Tuple[float, int]] = None) -> None:
+        """stat is the (mtime, size) of path if it is already known"""
         if parent:
             parent.add_child(self)
         self._parent = parent
         self._path = path
         self._size: Optional[int]
         if path:
-            stat = os.stat(path)
-            self._date = datetime.fromtimestamp(int(stat.st_mtime))
-            self._size = stat.st_size
+            if stat is None:
+                stat_result = os.stat(path)
+                stat = (stat_result.st_mtime, stat_result.st_size)
+            self._date_iso = iso_date(stat[0])
+            self._size = stat[1]
         else:
-            self._date = datetime.fromtimestamp(0)
+            self._date_iso = iso_date(0)
             self._size = 0
         self._type = itemtype
         self._cover: Optional[str] = None
+        self._xml_str: Optional[str] = None
         self._id = BaseItem.next_id
         BaseItem.next_id += 1
+        # Precomputed strings for the XML hot path
+        self._name = os.path.basename(path) if path else ''
+        self._id_str = str(self._id)
+        self._parent_id_str = str(parent.object_id) if parent else None
+        self._url_prefix: Optional[str] = None
 
     @property
     def object_id(self) -> int:
@@ -44,48 +73,69 @@ class BaseItem:
     @property
     def parent(self) -> "DirectoryItem":
         """Parent BaseItem"""
-        assert self._parent
-        return self._parent
+        return cast("DirectoryItem", self._parent)
 
     @property
     def name(self) -> str:
         """Item name"""
-        return os.path.basename(self._path or "")
+        return self._name
+
+    def url(self, mediatype: str) -> str:
+        """Get full URL of item"""
+        if self._url_prefix is None:
+            self._url_prefix = f"{_BASE_URL}/content/{self._id_str}/"
+        return self._url_prefix + mediatype
 
     @property
     def cover(self) -> Optional[str]:
         """Cover Art"""
         return self._cover
 
+    @property
+    def resolved(self) -> bool:
+        """Whether the item metadata is complete.  If not, await resolve() before describing the item"""
+        return True
+
+    async def resolve(self) -> None:
+        """Complete any item metadata still being gathered in the background"""
+
     async def get_path(self) -> str:
         """Item full path"""
-        assert self._path
-        return self._path
+        return cast(str, self._path)
 
     @property
     def size(self) -> int:
         """Item size"""
-        assert self._size
-        return self._size
+        return cast(int, self._size)
 
-    async def xml(self) -> ET.Element:
-        """Return XML describing item"""
-        root = ET.Element(self._type, {'id': f'{self._id}', 'restricted': '0'})
-        if self._parent:
-            root.attrib['parentID'] = f'{self._parent.object_id}'
-        ET.SubElement(root, 'dc:title').text = self.name
-        ET.SubElement(root, 'dc:date').text = self._date.isoformat()
+    def _invalidate_xml(self) -> None:
+        self._xml_str = None
+
+    def xml_str(self) -> str:
+        """Return serialized XML describing item (cached until the item changes)"""
+        if self._xml_str is None:
+            self._xml_str = self._build_str()
+        return self._xml_str
+
+    def _build_str(self) -> str:
+        """Serialize XML describing item"""
+        return self._str_head() + f'</{self._type}>'
+
+    def _str_head(self, attrs: str = '') -> str:
+        """Opening tag, title, date and cover art shared by all items"""
+        parent = f' parentID="{self._parent_id_str}"' if self._parent_id_str else ''
+        cover = ''
         if self._cover:
             # Cover art can be added as either
             #    <upnp:albumArtURI>
             #    or
             #    <res protocolInfo="http-get:*:image/jpeg:DLNA.ORG_PN=JPEG_TN;DLNA.ORG_OP=01;DLNA.ORG_CI=0">
             #    (or both)
-            cover = ET.SubElement(root, 'upnp:albumArtURI',
-                {'dlna:profileID': 'PNG_TN' if self._cover.endswith('png') else 'JPG_TN'})
-            cover.attrib.update(get_ns('dlna'))
-            cover.text = get_url(self, "cover")
-        return root
+            # the dlna namespace is declared once on the enclosing DIDL-Lite element
+            profile = 'PNG_TN' if self._cover.endswith('png') else 'JPG_TN'
+            cover = f'<upnp:albumArtURI dlna:profileID="{profile}">{escape(self.url(COVER))}</upnp:albumArtURI>'
+        return (f'<{self._type} id="{self._id_str}" restricted="0"{parent}{attrs}>'
+                f'<dc:title>{escape(self.name)}</dc:title><dc:date>{self._date_iso}</dc:date>{cover}')
 
     def add_child(self, item: "BaseItem") -> None:
         """Add a child item"""
@@ -93,22 +143,43 @@ class BaseItem:
 
 class DirectoryItem(BaseItem):
     """Directory item"""
-    def __init__(self, parent: Optional["DirectoryItem"], path: Optional[str]) -> None:
-        super().__init__(parent, path, 'container')
+    __slots__ = ('_children', '_update_id', '_sorted')
+    ITEM_KIND: ClassVar[str] = KIND_CONTAINER
+
+    def __init__(self, parent: Optional["DirectoryItem"], path: Optional[str],
+                 stat: Optional[Tuple[float, int]] = None) -> None:
+        super().__init__(parent, path, 'container', stat)
         self._children: List[BaseItem] = []
         self._update_id = 0
+        self._sorted: Optional[Tuple[int, List[BaseItem]]] = None
 
     def add_child(self, item: BaseItem) -> None:
         """Add a child item"""
         self._children.append(item)
         self._update_id += 1
+        self._invalidate_xml()
+
+    def child_changed(self) -> None:
+        """Record that the metadata of a child item has changed"""
+        self._update_id += 1
 
     @property
-    def children(self) -> List[BaseItem]:
-        """Return child objects"""
-        return self._children.copy()
+    def children(self) -> Sequence[BaseItem]:
+        """Return child objects.  This is the live list, it must not be modified"""
+        return self._children
 
-    async def xml(self) -> ET.Element:
+    @property
+    def child_count(self) -> int:
+        """Number of child objects"""
+        return len(self._children)
+
+    def sorted_children(self) -> List[BaseItem]:
+        """Return child objects sorted by name.  The returned list must not be modified"""
+        if not self._sorted or self._sorted[0] != self._update_id:
+            self._sorted = (self._update_id, sorted(self._children, key=lambda x: x.name))
+        return self._sorted[1]
+
+    def _build_str(self) -> str:
         """Container description
         <container id=\"1001\" parentID=\"1000\" restricted=\"0\" childCount=\"33\">
           <dc:title>DIR_NAME</dc:title>
@@ -120,10 +191,7 @@ class DirectoryItem(BaseItem):
           >http://.../1001?cover.jpg</upnp:albumArtURI>
         </container>
         """
-        root = await super().xml()
-        root.attrib['childCount'] = f'{len(self._children)}'
-        ET.SubElement(root, 'upnp:class').text = 'object.container'
-        return root
+        return self._str_head(f' childCount="{self.child_count}"') + '<upnp:class>object.container</upnp:class></container>'
 
     @property
     def update_id(self) -> int:
@@ -132,16 +200,28 @@ class DirectoryItem(BaseItem):
 
 class AudioItem(BaseItem):
     """Audio  item"""
-    def __init__(self, parent: DirectoryItem, path: str) -> None:
-        super().__init__(parent, path)
-        self._mimetype, _ = mimetypes.guess_type(path, strict=False)
+    __slots__ = ('_mimetype', '_protocol_info', '_size_str')
+    ITEM_KIND: ClassVar[str] = KIND_AUDIO
+
+    def __init__(self, parent: DirectoryItem, path: str, stat: Optional[Tuple[float, int]] = None) -> None:
+        super().__init__(parent, path, stat=stat)
+        self._mimetype = AUDIO_EXT.get(file_ext(self._name))
+        self._protocol_info = ''
+        self._size_str: Optional[str] = None
+        self._update_res()
+
+    def _update_res(self) -> None:
+        """Precompute the res attributes, needed whenever the mime type or size change"""
+        self._protocol_info = f'http-get:*:{self._mimetype}:*'
+        # The size of transcoded audio is unknown until it has been extracted
+        self._size_str = None if self._size is None else str(self._size)
 
     @property
     def mime_type(self) -> Optional[str]:
         """Mime type"""
         return self._mimetype
 
-    async def xml(self) -> ET.Element:
+    def _build_str(self) -> str:
         """
         <item id=\"1030.flac\" parentID=\"1001\" restricted=\"0\">
           <dc:title>01. Sgt. Pepper's Lonely Hearts Club Band (Remix).flac</dc:title>
@@ -159,32 +239,38 @@ class AudioItem(BaseItem):
           </res>
         </item>
         """
-        root = await super().xml()
-        ET.SubElement(root, 'upnp:class').text = 'object.item.audioItem'
-        protocol_info = f'http-get:*:{self._mimetype}:*'
-        media = ET.SubElement(root, 'res', {'protocolInfo': protocol_info, 'size': f"{self._size}"})
-        media.text = get_url(self, 'media')
-        return root
+        size = '' if self._size_str is None else f' size="{self._size_str}"'
+        return (self._str_head() + '<upnp:class>object.item.audioItem</upnp:class>'
+                f'<res protocolInfo="{escape(self._protocol_info, _ATTR_ENTITIES)}"{size}>'
+                f'{escape(self.url(MEDIA))}</res></item>')
 
 class TranscodeItem(AudioItem):
     """Video item that will be transcoded on playback"""
-    def __init__(self, parent: DirectoryItem, path: str, audio_extractor: AudioExtractor) -> None:
-        super().__init__(parent, path)
+    __slots__ = ('_audio_extractor', '_probe', '_audioext')
+    ITEM_KIND: ClassVar[str] = KIND_TRANSCODE
+
+    def __init__(self, parent: DirectoryItem, path: str, audio_extractor: AudioExtractor,
+                 stat: Optional[Tuple[float, int]] = None) -> None:
+        super().__init__(parent, path, stat)
         self._audio_extractor = audio_extractor
-        self._probe: Optional[asyncio.Task] = asyncio.create_task(audio_extractor.probe(path))
+        self._probe: Optional[asyncio.Task] = asyncio.create_task(audio_extractor.probe(path, stat))
         self._mimetype: Optional[str] = None
         self._audioext: Optional[str] = None
         self._size: Optional[int] = None
+        self._update_res()
         self._cover = "default.png"
 
     async def get_path(self) -> str:
         """Get full-path to item"""
-        assert self._path
-        path = await self._audio_extractor.get_path(self._path)
-        if self._size is None:
-            self._size = os.stat(path).st_size
-        if self._mimetype is None:
-            self._mimetype, _ = mimetypes.guess_type(path)
+        path = await self._audio_extractor.get_path(cast(str, self._path))
+        if self._size is None or self._mimetype is None:
+            if self._size is None:
+                self._size = os.stat(path).st_size
+            if self._mimetype is None:
+                self._mimetype = guess_by_ext(os.path.splitext(path)[1])
+            self._update_res()
+            self._invalidate_xml()
+            self.parent.child_changed()
         return path
 
     @property
@@ -195,27 +281,44 @@ class TranscodeItem(AudioItem):
         return self._size
 
     @property
-    def name(self) -> str:
-        """Item name"""
-        if self._audioext:
-            assert self._path
-            return os.path.basename(self._path).rsplit('.', 1)[0] + f'.{self._audioext}'
-        return super().name
+    def resolved(self) -> bool:
+        """Item metadata is complete once ffprobe has finished"""
+        return self._probe is None
 
-    async def xml(self) -> ET.Element:
-        """Create XML for item"""
+    async def resolve(self) -> None:
+        """Pick up the audio format once ffprobe has finished"""
         if self._probe:
             self._audioext = await self._probe
             self._probe = None
-            self._mimetype, _ = mimetypes.guess_type(f"media_file.{self._audioext}", strict=False)
+            if self._audioext:
+                # Named after the extracted audio rather than the video container
+                self._name = self._name.rpartition('.')[0] + '.' + self._audioext
+                self.parent.child_changed()
+            self._mimetype = guess_by_ext(f".{self._audioext}")
             if not self._mimetype:
                 self._mimetype = f"audio/{self._audioext}"
-        return await super().xml()
+            self._update_res()
+            self._invalidate_xml()
+
+def file_ext(name: str) -> str:
+    """Lowercased extension of a file name, as os.path.splitext() would find it"""
+    stem, dot, ext = name.rpartition('.')
+    # like splitext(), leading dots (hidden files) don't start an extension
+    if not dot or not stem.lstrip('.'):
+        return ''
+    return '.' + ext.lower()
+
+def iso_date(mtime: float) -> str:
+    """Local-time ISO-8601 date (to the second) for dc:date"""
+    _t = time.localtime(int(mtime))
+    return f'{_t.tm_year:04d}-{_t.tm_mon:02d}-{_t.tm_mday:02d}T{_t.tm_hour:02d}:{_t.tm_min:02d}:{_t.tm_sec:02d}'
 
-def get_url(item: BaseItem, mediatype: str) -> str:
-    """Get full URL of item"""
-    return f"{BaseItem.base_url}/content/{item.object_id}/{mediatype}"
+@lru_cache(maxsize=256)
+def guess_by_ext(ext: str) -> Optional[str]:
+    """mimetypes.guess_type() for a file extension, cached since libraries repeat the same few extensions"""
+    return mimetypes.guess_type('media_file' + ext, strict=False)[0]
 
 def set_base_url(url: str) -> None:
-    """Set the current URI as a static class variable for easy access"""
-    BaseItem.base_url = url
+    """Set the current URI for item URLs.  Must be called before items are described"""
+    global _BASE_URL  # pylint: disable=global-statement
+    _BASE_URL = url
@@ -1,4 +1,5 @@
 """Define common namespaces"""
+from functools import lru_cache
 from typing import Dict
 
 NAMESPACES = {
@@ -8,8 +9,9 @@ NAMESPACES = {
     'DIDL-Lite': 'urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/',
 }
 
+@lru_cache(maxsize=None)
 def get_ns(*namespaces: str) -> Dict[str, str]:
-    """Helper to return pre-defined XML namespaces"""
+    """Helper to return pre-defined XML namespaces.  The result is shared, do not modify it"""
     res = {}
     for ns_ in namespaces:
         if val := NAMESPACES.get(f'xmlns:{ns_}'):
@@ -19,3 +21,5 @@ def get_ns(*namespaces: str) -> Dict[str, str]:
         else:
             raise KeyError(f'{ns_} is not a valid namespace')
     return res
+
+DIDL_NS = get_ns('dc', 'upnp', 'dlna', 'DIDL-Lite')
@@ -0,0 +1,80 @@
+"""Persist directory listings between scans"""
+import logging
+import sqlite3
+import threading
+from typing import List, NamedTuple, Optional
+from .db import connect
+
+KIND_AUDIO = 'audio'
+KIND_VIDEO = 'video'
+
+class ScanEntry(NamedTuple):
+    """Cached directory entry"""
+    path: str
+    kind: str
+    mtime: float
+    size: int
+
+class ScanCache:
+    """Directory listings from previous scans.
+
+    A listing is reused as long as the directory's mtime is unchanged, which covers files being added,
+    removed or renamed.  Files rewritten in place without touching their directory are not detected, their
+    stored size and date are served until the directory changes.
+    The scanner calls it from several worker threads, so access to the connection is serialized.
+    """
+
+    def __init__(self, db_file: str) -> None:
+        self._db = connect(db_file)
+        self._cur = self._db.cursor()
+        self._lock = threading.Lock()
+        self._cur.execute("CREATE TABLE IF NOT EXISTS scan_dirs ("
+            "path TEXT PRIMARY KEY,"
+            "parent TEXT NOT NULL,"
+            "mtime REAL NOT NULL"
+            ")")
+        self._cur.execute("CREATE INDEX IF NOT EXISTS scan_dirs_parent ON scan_dirs (parent)")
+        self._cur.execute("CREATE TABLE IF NOT EXISTS scan_entries ("
+            "path TEXT PRIMARY KEY,"
+            "parent TEXT NOT NULL,"
+            "kind TEXT NOT NULL,"
+            "mtime REAL NOT NULL,"
+            "size INTEGER NOT NULL"
+            ")")
+        self._cur.execute("CREATE INDEX IF NOT EXISTS scan_entries_parent ON scan_entries (parent)")
+
+    def get_entries(self, path: str, mtime: float) -> Optional[List[ScanEntry]]:
+        """Get the stored listing of directory path, if it is unchanged since it was stored"""
+        with self._lock:
+            row = self._cur.execute("SELECT mtime FROM scan_dirs WHERE path = ?", (path,)).fetchone()
+            if not row or row[0] != mtime:
+                return None
+            return [ScanEntry(*row) for row in
+                    self._cur.execute("SELECT path, kind, mtime, size FROM scan_entries WHERE parent = ?", (path,))]
+
+    def set_entries(self, path: str, mtime: float, entries: List[ScanEntry], sub_dirs: List[str]) -> None:
+        """Replace the stored listing of directory path, forgetting sub-directories no longer in sub_dirs"""
+        with self._lock:
+            try:
+                self._cur.execute("BEGIN IMMEDIATE")
+                self._cur.execute("DELETE FROM scan_entries WHERE parent = ?", (path,))
+                self._cur.executemany("INSERT OR REPLACE INTO scan_entries (path, parent, kind, mtime, size) VALUES (?, ?, ?, ?, ?)",
+                                      [(_e.path, path, _e.kind, _e.mtime, _e.size) for _e in entries])
+                self._cur.execute("INSERT OR REPLACE INTO scan_dirs (path, parent, mtime) VALUES (?, ?, ?)",
+                                  (path, path.rpartition('/')[0], mtime))
+                current = set(sub_dirs)
+                for removed, in self._cur.execute("SELECT path FROM scan_dirs WHERE parent = ?", (path,)).fetchall():
+                    if removed not in current:
+                        self._forget(removed)
+                self._cur.execute("COMMIT")
+            except sqlite3.Error as _e:
+                logging.error("Failed to store scan results for %s: %s", path, _e)
+                if self._db.in_transaction:
+                    self._cur.execute("ROLLBACK")
+
+    def _forget(self, path: str) -> None:
+        """Remove a directory and everything below it"""
+        # paths below path/ sort between 'path/' and 'path0' ('0' follows '/')
+        below = (path, path + '/', path + '0')
+        self._cur.execute("DELETE FROM scan_entries WHERE parent = ? OR (parent >= ? AND parent < ?)", below)
+        self._cur.execute("DELETE FROM scan_dirs WHERE path = ? OR (path >= ? AND path < ?)", below)
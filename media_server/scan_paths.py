@@ -1,43 +1,153 @@
 """Create BaseItems for file paths"""
 import os
+import asyncio
 import logging
-import mimetypes
-from typing import List, Dict, AsyncGenerator
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, AsyncGenerator, Iterable, Optional, Tuple
 
 from async_upnp_client.client import UpnpDevice
-from .items import BaseItem, DirectoryItem, TranscodeItem, AudioItem
+from .items import BaseItem, DirectoryItem, TranscodeItem, AudioItem, AUDIO_EXT, VIDEO_EXT, file_ext
+from .scan_cache import ScanCache, ScanEntry, KIND_AUDIO, KIND_VIDEO
 
-async def scan_paths(paths: List[str], root_item: DirectoryItem, device: UpnpDevice) -> AsyncGenerator[BaseItem, None]:
-    """Async generator to generate BaseItems"""
+SCAN_WORKERS = 8        # directories read concurrently
+READ_AHEAD = 2 * SCAN_WORKERS  # directory reads started ahead of the scan, at most
+STAT_WORKERS = 8        # threads used to stat the files of a directory
+PARALLEL_STAT_MIN = 16  # directories with fewer media files are stat'ed serially
+_SCAN_POOL = ThreadPoolExecutor(max_workers=SCAN_WORKERS, thread_name_prefix='scan-dir')
+_STAT_POOL = ThreadPoolExecutor(max_workers=STAT_WORKERS, thread_name_prefix='scan-stat')
+# (sub-directories with their stat, media files) of a directory
+_Listing = Tuple[List[Tuple[str, os.stat_result]], List[ScanEntry]]
+
+async def scan_paths(paths: List[str], root_item: DirectoryItem, device: UpnpDevice,
+                     scan_cache: Optional[ScanCache] = None) -> AsyncGenerator[List[BaseItem], None]:
+    """Async generator to generate BaseItems, one list per directory"""
     audio_extractor = device.audio_extractor # type: ignore [attr-defined]
     for path in paths:
-        dir_cache:Dict[str, BaseItem] = {}
         if path.endswith('/') and path != '/':
             path = path[:-1]
-        for root, sub_dirs, files in os.walk(path):
-            if not files and not sub_dirs:
-                continue
-            parent: BaseItem
-            if root == path:
-                parent = root_item
-            else:
-                parent = dir_cache[os.path.dirname(root)]
-            assert isinstance(parent, DirectoryItem)
-            item = DirectoryItem(parent, root)
-            dir_cache[root] = item
-            yield item
-
-            for file in files:
-                full_path = os.path.join(root, file)
-                mime_type, _ = mimetypes.guess_type(file, strict=False)
-                if not mime_type:
-                    continue
-                child: AudioItem
-                if mime_type.startswith('video/'):
-                    child = TranscodeItem(item, full_path, audio_extractor)
-                elif mime_type.startswith("audio/"):
-                    child = AudioItem(item, full_path)
-                else:
-                    continue
-                logging.debug("Adding %s: %s", child.__class__.__name__, full_path)
-                yield child
+        try:
+            stat = os.stat(path)
+        except OSError as _e:
+            # e.g. an unmounted share, the other paths are still served
+            logging.error("Failed to scan %s: %s", path, _e)
+            continue
+        async for batch in _scan_tree(path, stat, root_item, audio_extractor, scan_cache):
+            yield batch
+
+async def _scan_tree(path: str, stat: os.stat_result, parent: DirectoryItem, audio_extractor: Any,
+                     scan_cache: Optional[ScanCache]) -> AsyncGenerator[List[BaseItem], None]:
+    """Generate BaseItems for a directory tree, depth-first.  Each directory is yielded with its files"""
+    def read(path: str, stat: os.stat_result) -> "asyncio.Future[Optional[_Listing]]":
+        # Directory reads and stats can block for a long time on network shares, so keep them off the event loop
+        return asyncio.get_running_loop().run_in_executor(_SCAN_POOL, _read_dir, path, stat.st_mtime, scan_cache)
+
+    # An explicit stack rather than recursion, so items aren't passed up through a generator per directory level.
+    # The next READ_AHEAD directories to be consumed are read ahead in the pool while earlier items are yielded,
+    # but are still consumed depth-first, so items are created on the event loop in a deterministic order.
+    stack = [(path, stat, parent)]
+    pending: Dict[str, "asyncio.Future[Optional[_Listing]]"] = {}
+
+    def read_ahead() -> None:
+        # The end of the stack is consumed next.  Reads are bounded, so finished listings don't pile up in memory
+        for next_path, next_stat, _ in reversed(stack):
+            if len(pending) >= READ_AHEAD:
+                break
+            if next_path not in pending:
+                pending[next_path] = read(next_path, next_stat)
+
+    # checked once per tree rather than going through the logging machinery for every file
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    while stack:
+        path, stat, parent = stack.pop()
+        listing_future = pending.pop(path, None) or read(path, stat)
+        read_ahead()
+        listing = await listing_future
+        if listing is None:
+            continue
+        sub_dirs, files = listing
+        item = DirectoryItem(parent, path, (stat.st_mtime, stat.st_size))
+        # One batch per directory, so the consumer is resumed per directory rather than per file
+        yield _dir_batch(item, files, audio_extractor, debug)
+
+        # reversed, so sub-directories are still visited in listing order
+        stack.extend((sub_path, sub_stat, item) for sub_path, sub_stat in reversed(sub_dirs))
+        read_ahead()
+
+def _dir_batch(item: DirectoryItem, files: List[ScanEntry], audio_extractor: Any, debug: bool) -> List[BaseItem]:
+    """Create the items for the media files of a directory, preceded by the directory itself"""
+    batch: List[BaseItem] = [item]
+    for entry in files:
+        child: AudioItem
+        if entry.kind == KIND_VIDEO:
+            child = TranscodeItem(item, entry.path, audio_extractor, (entry.mtime, entry.size))
+        else:
+            child = AudioItem(item, entry.path, (entry.mtime, entry.size))
+        if debug:
+            logging.debug("Adding %s: %s", child.__class__.__name__, entry.path)
+        batch.append(child)
+    return batch
+
+def _read_dir(path: str, mtime: float, scan_cache: Optional[ScanCache]) -> Optional[_Listing]:
+    """Get the sub-directories and media files of a directory, or None if it is empty or unreadable.  Blocking"""
+    # Like os.walk(), a directory that can't be read is skipped (with its sub-tree) rather than ending the scan
+    try:
+        with os.scandir(path) as dir_it:
+            entries = list(dir_it)
+    except OSError as _e:
+        logging.error("Failed to read directory %s: %s", path, _e)
+        return None
+    if not entries:
+        if scan_cache:
+            # so that anything stored for its former contents is forgotten
+            _list_files(path, mtime, [], [], scan_cache)
+        return None
+    # A single pass over the entries.  is_dir()/is_file() use the d_type from the directory read, only
+    # symlinks need a stat.  Like os.walk(), symlinked directories are not followed.  Broken links are skipped.
+    sub_dirs: List[Tuple[str, os.stat_result]] = []
+    files: List[os.DirEntry] = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if sub_stat := _stat(entry):
+                sub_dirs.append((entry.path, sub_stat))
+        elif entry.is_file():
+            files.append(entry)
+    return sub_dirs, _list_files(path, mtime, files, [_p for _p, _s in sub_dirs], scan_cache)
+
+def _list_files(root: str, mtime: float, files: List[os.DirEntry], sub_dirs: List[str],
+                scan_cache: Optional[ScanCache]) -> List[ScanEntry]:
+    """Get the media files in a directory"""
+    # Unchanged directories reuse the previous listing, skipping the per-file stat and mimetype lookup.
+    # A file rewritten in place (e.g. a tag edit) doesn't change its directory's mtime, so it isn't noticed.
+    entries = scan_cache.get_entries(root, mtime) if scan_cache else None
+    if entries is None:
+        entries = _scan_files(files)
+        if scan_cache:
+            scan_cache.set_entries(root, mtime, entries, sub_dirs)
+    return entries
+
+def _scan_files(files: List[os.DirEntry]) -> List[ScanEntry]:
+    """Create entries for the media files in a directory"""
+    media: List[os.DirEntry] = []
+    kinds: List[str] = []
+    for file in files:
+        ext = file_ext(file.name)
+        if ext in VIDEO_EXT:
+            kinds.append(KIND_VIDEO)
+        elif ext in AUDIO_EXT:
+            kinds.append(KIND_AUDIO)
+        else:
+            continue
+        media.append(file)
+    # Keep several stats in flight at once, so large directories on slow storage aren't stalled on each round-trip
+    stats: Iterable[Optional[os.stat_result]] = (_STAT_POOL.map(_stat, media) if len(media) >= PARALLEL_STAT_MIN
+                                                 else [_stat(file) for file in media])
+    return [ScanEntry(file.path, kind, stat.st_mtime, stat.st_size)
+            for file, kind, stat in zip(media, kinds, stats) if stat]
+
+def _stat(entry: os.DirEntry) -> Optional[os.stat_result]:
+    """Stat a directory entry, or None if it has gone away or can't be accessed"""
+    try:
+        return entry.stat()
+    except OSError as _e:
+        logging.error("Failed to stat %s: %s", entry.path, _e)
+        return None
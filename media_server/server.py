@@ -3,30 +3,32 @@
 
 import asyncio
 import logging
-import re
 import xml.etree.ElementTree as ET
 import argparse
 
 from time import time
 from functools import partial
-from http import HTTPStatus
-from typing import cast, Callable, Type, Tuple, Optional, Union
+from typing import cast, Callable, Dict, List, Type
 from aiohttp import web
-from multidict import CIMultiDictProxy
 
-from async_generator import async_generator, yield_  # type: ignore [import]
+try:
+    import uvloop  # type: ignore [import]
+except ImportError:
+    uvloop = None
 
 from async_upnp_client.client import UpnpRequester
 from async_upnp_client.const import DeviceInfo
 from async_upnp_client.server import UpnpServer, UpnpServerDevice
-from .items import set_base_url, AudioItem
+from .items import set_base_url, AudioItem, COVER, MEDIA_KINDS
 from .content_directory import ContentDirectoryService
 from .connection_manager import ConnectionManagerService
 from .scan_paths import scan_paths
+from .scan_cache import ScanCache
 from .audio_extract import AudioExtractor
 
 SOURCE = ("192.168.1.85", 0)  # Your IP here!
 HTTP_PORT = 8000
+FILE_CHUNK_SIZE = 1024 * 1024  # read size when sendfile() isn't available (e.g. AIOHTTP_NOSENDFILE)
 
 class MediaServerDevice(UpnpServerDevice):
     """Media Server Device."""
@@ -64,76 +66,64 @@ class MediaServerDevice(UpnpServerDevice):
         )
         set_base_url(base_uri)
         # route decorator doesn't support instance-methods natively
-        # so convert static-method call to instance method call here
+        # so swap each decorated function for the matching bound method here
         self.ROUTES = [  # pylint: disable=invalid-name
-            web.RouteDef(route.method, route.path, partial(route.handler, self), route.kwargs)  # type: ignore [attr-defined]
+            web.RouteDef(route.method, route.path, getattr(self, route.handler.__name__), route.kwargs)  # type: ignore [attr-defined]
             for route in self._routes]
-        self._content_dir = next(svc for svc in self.services.values() if isinstance(svc, ContentDirectoryService))
+        # services are keyed on their service type
+        self._content_dir = cast(ContentDirectoryService,
+                                 self.services[ContentDirectoryService.SERVICE_DEFINITION.service_type])
         self.audio_extractor = audio_extractor_cls()
 
     @_routes.get(r"/content/{object_id:\d+}/{media_type}")   # type: ignore [arg-type]
-    async def handle_media(self, request: web.Request) -> Union[web.Response, web.FileResponse]:
+    async def handle_media(self, request: web.Request) -> web.StreamResponse:
         """URL handler for streaming media"""
-        object_id = int(request.match_info['object_id'])
-        media_type = request.match_info['media_type']
-        item = self._content_dir.get_item(object_id)
-        if not item:
+        match_info = request.match_info
+        object_id = int(match_info['object_id'])
+        media_type = match_info['media_type']
+        base_item = self._content_dir.get_item(object_id)
+        if base_item is None:
             raise web.HTTPNotFound
-        if not isinstance(item, AudioItem):
-            logging.error("Tried to query  %s media item: %s", item.__class__.__name__, item.name)
+        if base_item.ITEM_KIND not in MEDIA_KINDS:
+            logging.error("Tried to query  %s media item: %s", base_item.__class__.__name__, base_item.name)
             raise web.HTTPNotFound
-        if request.method == 'HEAD':
-            raise web.HTTPOk()
-        if media_type == 'cover':
+        item = cast(AudioItem, base_item)
+        if media_type == COVER:
+            # FileResponse answers HEAD itself, with only a stat of the image
             if item.cover:
                 return web.FileResponse(item.cover)
             raise web.HTTPNotFound
+        if request.method == 'HEAD':
+            # Answer from the item metadata, without locating the file or starting an audio extraction
+            if not item.resolved:
+                await item.resolve()
+            return web.Response(headers=self.media_headers(item, head=True))
 
         _path = await item.get_path()
-
-        @async_generator
-        async def generate(chunk_size: int=2**16) -> None:
-            # Default to 64k chunks
-            with open(_path, 'rb') as _f:
-                _f.seek(start)
-                for data in iter(partial(_f.read, chunk_size), b''):
-                    await yield_(data)
-
         if not _path:
             raise web.HTTPNotFound
-        part, start, end = self.get_range(request.headers)
+        headers = self.media_headers(item)
+        logging.info("Playing: %s", item.name)
+        # FileResponse handles Range requests itself and streams the file with sendfile()
+        return web.FileResponse(_path, chunk_size=FILE_CHUNK_SIZE, headers=headers)
+
+    @staticmethod
+    def media_headers(item: AudioItem, head: bool = False) -> Dict[str, str]:
+        """Response headers for a media item"""
         mime_type = item.mime_type
-        end = item.size if end is None else end
-        size = str(end-start)
         if not mime_type:
             raise web.HTTPNotFound
-
-        headers: dict[str, str] = {'Content-Length': size, 'Content-Type': mime_type, 'Accept-Ranges': 'bytes',
+        headers = {'Content-Type': mime_type,
                    # DLNA.ORG_OP = Time range capable / Byte range capable
                    'Contentfeatures.dlna.org': 'DLNA.ORG_OP=01'  # TV will try to read entire file without this
                    }
-        if part:
-            headers['Content-Range'] = f'bytes {start}-{end-1}/{size}'
-        print(headers)
-        logging.info("Playing: %s", item.name)
-        response = web.Response(
-            body=generate(),
-            status=HTTPStatus.PARTIAL_CONTENT if part else HTTPStatus.OK, headers=headers)
-        return response
-
-    @staticmethod
-    def get_range(headers: CIMultiDictProxy[str]) -> Tuple[bool, int, Optional[int]]:
-        """Get requested byte range from headers"""
-        byte_range = headers.get('Range', headers.get('range'))
-        match = None if not byte_range else re.match(r'bytes=(?P<start>\d+)-(?P<end>\d+)?', byte_range)
-        if not match:
-            return False, 0, None
-        start = match.group('start')
-        end = match.group('end')
-        start = int(start)
-        if end is not None:
-            end = int(end)
-        return True, start, end
+        if head:
+            # FileResponse adds these itself for GET
+            headers['Accept-Ranges'] = 'bytes'
+            if item.size:
+                # unknown for transcoded audio that hasn't been extracted yet
+                headers['Content-Length'] = str(item.size)
+        return headers
 
 async def async_main(server: UpnpServer) -> None:
     """Async entrypoint."""
@@ -147,7 +137,7 @@ def main() -> None:
     parser.add_argument("--media", required=True, nargs='+', help="Media paths to serve")
     parser.add_argument("--host", required=True, help="Host IP address to listen on")
     parser.add_argument("--port", type=int, default = 8000, help="Port to listen on")
-    parser.add_argument("--dbfile", default="cache.sqlite", help="Database file for caching audio-extractor")
+    parser.add_argument("--dbfile", default="cache.sqlite", help="Database file for caching audio-extractor and scan results")
     parser.add_argument("--cache_dir", default="/tmp/audio_cache", help="Directory for audio-extractor to chache files")
     parser.add_argument("--max-cache-size", type=int, default=1_000_000_000, help="Maximum cache size for auido-extractor")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose logging")
@@ -157,14 +147,25 @@ def main() -> None:
 
     boot_id = int(time())
     config_id = 1
-    audio_extractor_partial = partial(AudioExtractor, args.dbfile, args.cache_dir, args.max_cache_size)
-    msd_partial = cast(Type[UpnpServerDevice], partial(MediaServerDevice, audio_extractor_partial))
-    ContentDirectoryService.SCANNER = partial(scan_paths, args.media)
+    audio_extractors: List[AudioExtractor] = []
+
+    def create_audio_extractor() -> AudioExtractor:
+        # kept so that its queued DB writes can be flushed on shutdown
+        audio_extractors.append(AudioExtractor(args.dbfile, args.cache_dir, args.max_cache_size))
+        return audio_extractors[-1]
+
+    msd_partial = cast(Type[UpnpServerDevice], partial(MediaServerDevice, create_audio_extractor))
+    ContentDirectoryService.SCANNER = partial(scan_paths, args.media, scan_cache=ScanCache(args.dbfile))
     server = UpnpServer(msd_partial, (args.host, 0), http_port=args.port, boot_id=boot_id, config_id=config_id)
 
+    if uvloop:
+        # libuv-based loop has a much cheaper subprocess/pipe path for ffprobe/ffmpeg
+        uvloop.install()
     loop = asyncio.get_event_loop()
     try:
         loop.run_until_complete(async_main(server))
     except KeyboardInterrupt:
         print("KeyboardInterrupt")
     loop.run_until_complete(server.async_stop())
+    for audio_extractor in audio_extractors:
+        audio_extractor.flush_writes()